@@ -1,15 +1,24 @@
-import hashlib, json, os, re, time
+import asyncio, atexit, os, re, sqlite3, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urljoin
 from dataclasses import dataclass
+from functools import lru_cache
+import httpx
+import blake3
+import orjson
 import requests
-from xml.etree import ElementTree as ET
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from lxml import etree
+from bs4 import BeautifulSoup, FeatureNotFound
+from selectolax.lexbor import LexborHTMLParser
 import yaml
 from datetime import datetime
 import csv
 from pathlib import Path
 
 STATE_FILE = "state.json"
+STATE_DB = "state.db"
 CONFIG_FILE = "sites.yml"
 
 # Secrets / env
@@ -21,8 +30,38 @@ SHEET_KEY = os.getenv("SHEET_KEY")
 DEFAULT_HEADERS = {
     "User-Agent": "CompetitorWatcher/1.0 (+https://github.com/your-repo)",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    # nén phía server; requests/httpx tự giải nén (br cần package brotli)
+    "Accept-Encoding": "gzip, br",
 }
 
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+
+# Fingerprint chỉ để phát hiện thay đổi, không cần hash mật mã -> BLAKE3 (nhanh hơn SHA-256).
+# Hash lưu kèm namespace để phân biệt với hash SHA-256 cũ trong state.
+HASH_PREFIX = "blake3:"
+STREAM_CHUNK_SIZE = 64 * 1024
+# số thread dò sitemap/RSS song song cho mỗi site
+PROBE_WORKERS = 8
+# Slack: gộp báo cáo các site vào 1 message, tách nếu payload > ~40KB
+SLACK_MAX_BYTES = 40_000
+REPORT_SEPARATOR = "\n\n---\n\n"
+
+# Session dùng chung để giữ kết nối (keep-alive) giữa các request tới cùng host
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update(DEFAULT_HEADERS)
+atexit.register(SESSION.close)
+
+# parser C (lxml) nhanh hơn nhiều so với html.parser; fallback nếu chưa cài
+try:
+    BeautifulSoup("", "lxml")
+    HTML_PARSER = "lxml"
+except FeatureNotFound:
+    HTML_PARSER = "html.parser"
+
 @dataclass
 class Limits:
     max_urls_per_site: int = 1500
@@ -30,6 +69,7 @@ class Limits:
     request_timeout_sec: int = 20
     request_retries: int = 2
     polite_sleep_ms: int = 150
+    per_host_concurrency: int = 4
 
 def load_config():
     with open(CONFIG_FILE, "r", encoding="utf-8") as f:
@@ -43,6 +83,7 @@ def load_config():
         request_timeout_sec=int(limits_cfg.get("request_timeout_sec", 20)),
         request_retries=int(limits_cfg.get("request_retries", 2)),
         polite_sleep_ms=int(limits_cfg.get("polite_sleep_ms", 150)),
+        per_host_concurrency=int(limits_cfg.get("per_host_concurrency", 4)),
     )
     options = cfg.get("options", {})
     return sites, change_threshold, limits, options
@@ -51,12 +92,11 @@ def backoff_sleep(attempt):
     # exponential backoff nhỏ: 0.5s, 1s, 2s, tối đa 4s
     time.sleep(min(2 ** attempt * 0.5, 4.0))
 
-def fetch(url, headers=None, timeout=20, retries=2):
-    headers = headers or DEFAULT_HEADERS
+def fetch(url, headers=None, timeout=20, retries=2, stream=False):
     last_err = None
     for attempt in range(retries + 1):
         try:
-            r = requests.get(url, headers=headers, timeout=timeout)
+            r = SESSION.get(url, headers=headers, timeout=timeout, stream=stream)
             r.raise_for_status()
             return r
         except Exception as e:
@@ -66,34 +106,87 @@ def fetch(url, headers=None, timeout=20, retries=2):
             else:
                 raise last_err
 
-def try_urls(urls, timeout, retries):
-    for u in urls:
+async def backoff_sleep_async(attempt):
+    await asyncio.sleep(min(2 ** attempt * 0.5, 4.0))
+
+async def fetch_digest(client, url, headers=None, timeout=20, retries=2):
+    # stream body theo chunk và hash dần; trả về (hash, chunks, validators) -> chỉ nối bytes khi thật sự cần parse
+    # 304 Not Modified -> (None, None, validators)
+    last_err = None
+    for attempt in range(retries + 1):
         try:
-            r = fetch(u, timeout=timeout, retries=retries)
-            return u, r
-        except Exception:
-            continue
-    return None, None
+            async with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+                validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+                if r.status_code == 304:
+                    return None, None, validators
+                r.raise_for_status()
+                hasher = blake3.blake3()
+                chunks = []
+                async for chunk in r.aiter_bytes(STREAM_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    chunks.append(chunk)
+                return HASH_PREFIX + hasher.hexdigest(), chunks, validators
+        except Exception as e:
+            last_err = e
+            if attempt < retries:
+                await backoff_sleep_async(attempt)
+            else:
+                raise last_err
+
+def probe_url(u, timeout, retries):
+    # chỉ cần biết URL trả về 2xx: stream=True rồi đóng ngay, không tải body
+    with fetch(u, timeout=timeout, retries=retries, stream=True):
+        return u
+
+def try_urls(urls, timeout, retries):
+    # probe song song nhưng vẫn ưu tiên theo thứ tự candidates (sitemap trong robots.txt trước)
+    if not urls:
+        return None
+    pool = ThreadPoolExecutor(max_workers=min(PROBE_WORKERS, len(urls)))
+    try:
+        futures = [pool.submit(probe_url, u, timeout, retries) for u in urls]
+        for fut in futures:
+            try:
+                return fut.result()
+            except Exception:
+                continue
+        return None
+    finally:
+        # không chờ các probe còn lại (chỉ tải header nên kết thúc nhanh)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+# dòng "Sitemap: <url>" trong robots.txt, quét thẳng trên bytes
+ROBOTS_SITEMAP_RE = re.compile(rb"(?im)^[ \t]*sitemap:[ \t]*(\S+)")
 
 def robots_sitemaps(base):
     # đọc robots.txt để tìm dòng Sitemap:
     try:
         robots = urljoin(base, "/robots.txt")
         r = fetch(robots, timeout=10, retries=1)
-        sitemaps = []
-        for line in r.text.splitlines():
-            if line.lower().startswith("sitemap:"):
-                sitemaps.append(line.split(":", 1)[1].strip())
-        return sitemaps
+        return [m.group(1).decode("utf-8", "replace") for m in ROBOTS_SITEMAP_RE.finditer(r.content)]
     except Exception:
         return []
 
+def iter_xml_tags(url, tags, timeout, retries):
+    # stream + iterparse: không giữ cả cây XML trong RAM
+    with fetch(url, timeout=timeout, retries=retries, stream=True) as r:
+        r.raw.decode_content = True
+        for _, el in etree.iterparse(r.raw, events=("end",), tag=tags):
+            parent = el.getparent()
+            yield el, parent
+            # giải phóng element đã xử lý và các phần tử anh em phía trước của parent
+            el.clear()
+            # (parent là root thì anh em phía trước là PI/comment cấp document, không xoá được)
+            grandparent = parent.getparent() if parent is not None else None
+            if grandparent is not None:
+                while parent.getprevious() is not None:
+                    del grandparent[0]
+
 def parse_sitemap_collect(url, timeout, retries, limits):
     # Đệ quy: sitemap index -> sitemap -> urlset
     collected = set()
     seen = set()
     stack = [url]
-    ns = {"sm": "http://www.sitemaps.org/schemas/sitemap/0.9"}
 
     while stack and len(collected) < limits.max_urls_per_site:
         cur = stack.pop()
@@ -101,22 +194,20 @@ def parse_sitemap_collect(url, timeout, retries, limits):
             continue
         seen.add(cur)
         try:
-            r = fetch(cur, timeout=timeout, retries=retries)
-            root = ET.fromstring(r.text)
+            for loc, parent in iter_xml_tags(cur, (SITEMAP_NS + "loc",), timeout, retries):
+                loc_url = (loc.text or "").strip()
+                if not loc_url or parent is None:
+                    continue
+                if parent.tag == SITEMAP_NS + "sitemap":
+                    # sitemapindex
+                    stack.append(loc_url)
+                elif parent.tag == SITEMAP_NS + "url":
+                    # urlset
+                    collected.add(loc_url)
+                    if len(collected) >= limits.max_urls_per_site:
+                        break
         except Exception:
             continue
-
-        # sitemapindex
-        for loc in root.findall(".//sm:sitemap/sm:loc", ns):
-            loc_url = loc.text.strip()
-            stack.append(loc_url)
-
-        # urlset
-        for loc in root.findall(".//sm:url/sm:loc", ns):
-            loc_url = loc.text.strip()
-            collected.add(loc_url)
-            if len(collected) >= limits.max_urls_per_site:
-                break
     return collected
 
 def discover_sitemaps(base_url, timeout, retries):
@@ -127,109 +218,265 @@ def discover_sitemaps(base_url, timeout, retries):
     ]
     robots_list = robots_sitemaps(base)
     candidates = robots_list + candidates
-    chosen, resp = try_urls(candidates, timeout=timeout, retries=retries)
+    chosen = try_urls(candidates, timeout=timeout, retries=retries)
     return chosen
 
+def is_feed_content_type(headers):
+    ct = (headers.get("content-type") or "").lower()
+    return "xml" in ct or "rss" in ct or "atom" in ct
+
+def probe_feed(u, timeout, retries):
+    # HEAD trước: chỉ cần content-type, không tải body
+    try:
+        r = SESSION.head(u, timeout=timeout, allow_redirects=True)
+        if r.ok and is_feed_content_type(r.headers):
+            return u
+    except Exception:
+        pass
+    # HEAD lỗi / bị từ chối (405, 403, 404...) / content-type không rõ
+    # -> GET (có retry như fetch) và chỉ đọc 512 byte đầu để sniff <?xml
+    try:
+        with fetch(u, headers={"Range": "bytes=0-511"}, timeout=timeout, retries=retries, stream=True) as r:
+            head = r.raw.read(512, decode_content=True)
+            if is_feed_content_type(r.headers) or head.lstrip().startswith(b"<?xml"):
+                return u
+    except Exception:
+        pass
+    return None
+
 def discover_rss_feeds(base_url, timeout, retries):
     feeds = []
     base = base_url.rstrip("/")
-    # common paths
+    # common paths (dò song song)
     common = ["/feed", "/rss", "/rss.xml", "/atom.xml"]
-    for path in common:
-        u = urljoin(base, path)
-        try:
-            r = fetch(u, timeout=timeout, retries=retries)
-            ct = (r.headers.get("content-type") or "").lower()
-            if "xml" in ct or "rss" in ct or "atom" in ct or r.text.strip().startswith("<?xml"):
+    candidates = [urljoin(base, path) for path in common]
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+        for u in pool.map(lambda u: probe_feed(u, timeout, retries), candidates):
+            if u:
                 feeds.append(u)
-        except Exception:
-            pass
 
     # parse homepage <link rel="alternate" type="application/rss+xml">
-    try:
-        r = fetch(base, timeout=timeout, retries=retries)
-        soup = BeautifulSoup(r.text, "html.parser")
-        for link in soup.find_all("link", attrs={"rel": lambda x: x and "alternate" in x}):
-            t = (link.get("type") or "").lower()
-            if "rss" in t or "atom" in t or "xml" in t:
-                href = link.get("href")
-                if href:
-                    feeds.append(urljoin(base, href))
-    except Exception:
-        pass
+    # (chỉ khi các path phổ biến không ra feed nào -> tiết kiệm 1 lần fetch + parse HTML)
+    if not feeds:
+        try:
+            r = fetch(base, timeout=timeout, retries=retries)
+            soup = BeautifulSoup(r.text, HTML_PARSER)
+            for link in soup.find_all("link", attrs={"rel": lambda x: x and "alternate" in x}):
+                t = (link.get("type") or "").lower()
+                if "rss" in t or "atom" in t or "xml" in t:
+                    href = link.get("href")
+                    if href:
+                        feeds.append(urljoin(base, href))
+        except Exception:
+            pass
 
-    # unique
-    dedup = []
-    for f in feeds:
-        if f not in dedup:
-            dedup.append(f)
-    return dedup
+    # unique (giữ thứ tự)
+    return list(dict.fromkeys(feeds))
 
 def parse_rss_items(feed_url, timeout, retries, limits):
+    urls = set()
     try:
-        r = fetch(feed_url, timeout=timeout, retries=retries)
-        root = ET.fromstring(r.text)
-        urls = set()
-        # RSS 2.0
-        for item in root.findall(".//item/link"):
-            if item.text:
-                urls.add(item.text.strip())
-        # Atom
-        for entry in root.findall(".//{http://www.w3.org/2005/Atom}entry/{http://www.w3.org/2005/Atom}link"):
-            href = entry.get("href")
+        for link, parent in iter_xml_tags(feed_url, ("link", ATOM_NS + "link"), timeout, retries):
+            if parent is None:
+                continue
+            if link.tag == "link" and parent.tag == "item":
+                # RSS 2.0
+                href = link.text
+            elif link.tag == ATOM_NS + "link" and parent.tag == ATOM_NS + "entry":
+                # Atom
+                href = link.get("href")
+            else:
+                continue
             if href:
                 urls.add(href.strip())
-        return set(list(urls)[:limits.max_urls_per_site])
+            if len(urls) >= limits.max_urls_per_site:
+                break
     except Exception:
-        return set()
+        pass
+    return urls
 
 def normalize_text(html):
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["script", "style", "noscript"]):
+    # selectolax (engine C, backend lexbor) nhanh hơn hẳn BeautifulSoup cho việc lấy text
+    tree = LexborHTMLParser(html)
+    for tag in tree.css("script, style, noscript"):
         tag.decompose()
-    text = soup.get_text(separator=" ", strip=True)
-    text = re.sub(r"\s+", " ", text)
-    return text
-
-def content_fingerprint(url, timeout, retries, polite_ms):
-    r = fetch(url, timeout=timeout, retries=retries)
-    text = normalize_text(r.text)
-    h = hashlib.sha256(text.encode("utf-8")).hexdigest()
-    length = len(text)
-    # lịch sự một chút (ms -> sec)
-    time.sleep(max(0.0, polite_ms / 1000.0))
-    return h, length
-
-def should_include(url, include_paths, exclude_paths):
-    path = urlparse(url).path or "/"
-    if include_paths:
-        ok = any(path.startswith(p) for p in include_paths)
-        if not ok:
-            return False
-    if exclude_paths:
-        if any(path.startswith(p) for p in exclude_paths):
-            return False
+    if tree.body is None:
+        return ""
+    text = tree.body.text(separator=" ", strip=True)
+    return " ".join(text.split())
+
+def digest(data):
+    return HASH_PREFIX + blake3.blake3(data).hexdigest()
+
+async def content_fingerprint(client, url, prev, timeout, retries):
+    # conditional GET: gửi lại ETag / Last-Modified đã lưu
+    headers = {}
+    if prev and prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev and prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+
+    h_raw, chunks, validators = await fetch_digest(client, url, headers=headers, timeout=timeout, retries=retries)
+    if h_raw is None:
+        # 304: server xác nhận không đổi -> dùng lại fingerprint cũ, không tải/hash lại
+        h_raw = prev.get("hash_raw")
+        h = prev["hash"]
+        length = int(prev.get("len", 0))
+        validators = {k: v or prev.get(k) for k, v in validators.items()}
+    elif prev and prev.get("hash_raw") == h_raw:
+        # bytes y hệt lần trước -> khỏi parse HTML, dùng lại fingerprint cũ
+        h = prev["hash"]
+        length = int(prev.get("len", 0))
+    else:
+        # bytes khác (có thể chỉ do tracker/timestamp) -> so theo text đã chuẩn hoá
+        text = normalize_text(b"".join(chunks).decode("utf-8", "replace"))
+        h = digest(text.encode("utf-8"))
+        length = len(text)
+    entry = {"hash": h, "len": length, "hash_raw": h_raw}
+    entry.update({k: v for k, v in validators.items() if v})
+    return entry
+
+class HostLimiter:
+    # giãn cách request theo từng host (lịch sự), các host khác nhau chạy song song
+    def __init__(self, interval):
+        self.interval = interval
+        self.next = defaultdict(float)
+
+    async def wait(self, host):
+        now = time.monotonic()
+        start = max(now, self.next[host])
+        # giữ chỗ trước khi await để các task cùng host không lấy trùng slot
+        self.next[host] = start + self.interval
+        await asyncio.sleep(start - now)
+
+async def bounded_fingerprint(sem, limiter, host, client, url, prev, limits):
+    # semaphore theo host: giới hạn số request đồng thời tới cùng 1 domain
+    async with sem:
+        await limiter.wait(host)
+        return await content_fingerprint(client, url, prev, limits.request_timeout_sec, limits.request_retries)
+
+def make_client(limits):
+    # HTTP/2: nhiều request đồng thời tới cùng host đi chung 1 kết nối TCP/TLS
+    return httpx.AsyncClient(
+        http2=True,
+        headers=DEFAULT_HEADERS,
+        timeout=limits.request_timeout_sec,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    )
+
+@lru_cache(maxsize=4096)
+def url_parts(url):
+    # parse mỗi URL một lần -> (netloc, path)
+    p = urlparse(url)
+    return p.netloc, p.path or "/"
+
+def should_include(path, include_paths, exclude_paths):
+    # include_paths / exclude_paths là tuple: str.startswith nhận tuple, so khớp trong C
+    if include_paths and not path.startswith(include_paths):
+        return False
+    if exclude_paths and path.startswith(exclude_paths):
+        return False
     return True
 
+def batch_reports(reports, max_bytes=SLACK_MAX_BYTES):
+    # nối các báo cáo thành 1 message; chỉ tách khi vượt giới hạn kích thước payload
+    batches, cur = [], ""
+    for r in reports:
+        candidate = cur + REPORT_SEPARATOR + r if cur else r
+        if cur and len(candidate.encode("utf-8")) > max_bytes:
+            batches.append(cur)
+            cur = r
+        else:
+            cur = candidate
+    if cur:
+        batches.append(cur)
+    return batches
+
+def compile_prefix_re(prefixes):
+    # gộp các prefix thành 1 regex alternation (match ở đầu chuỗi)
+    if not prefixes:
+        return None
+    return re.compile("(?:" + "|".join(map(re.escape, prefixes)) + ")")
+
 def post_to_slack(webhook, text):
     if not webhook:
         print("⚠️ SLACK_WEBHOOK_URL is not set; skipping Slack notify.")
         return
     payload = {"text": text}
     try:
-        requests.post(webhook, json=payload, timeout=10)
+        SESSION.post(webhook, json=payload, timeout=10)
     except Exception as e:
         print("Slack error:", e)
 
 def load_state():
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return {"sites": {}}
 
 def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    # ghi ra file tạm rồi os.replace: không bao giờ để lại state.json ghi dở
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(state, option=orjson.OPT_NON_STR_KEYS))
+    os.replace(tmp, STATE_FILE)
+
+# ---------------- URL state (SQLite) ---------------- #
+# state.json chỉ giữ metadata theo site (last_run); fingerprint từng URL nằm trong state.db
+# để chỉ đọc các dòng cần thiết và chỉ ghi lại những dòng thay đổi.
+
+URL_COLUMNS = ("hash", "hash_raw", "len", "etag", "last_modified")
+
+def open_url_store():
+    conn = sqlite3.connect(STATE_DB, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS urls("
+        "domain TEXT, url TEXT, hash TEXT, hash_raw TEXT, len INT, etag TEXT, last_modified TEXT, "
+        "PRIMARY KEY(domain, url)) WITHOUT ROWID"
+    )
+    return conn
+
+def load_url_entry(conn, domain, url):
+    row = conn.execute(
+        "SELECT hash, hash_raw, len, etag, last_modified FROM urls WHERE domain=? AND url=?",
+        (domain, url),
+    ).fetchone()
+    if row is None:
+        return None
+    return {k: v for k, v in zip(URL_COLUMNS, row) if v is not None}
+
+def load_site_urls(conn, domain):
+    return [u for (u,) in conn.execute("SELECT url FROM urls WHERE domain=?", (domain,))]
+
+def save_url_entries(conn, domain, entries):
+    # entries: {url: {"hash", "len", ...}} -> ghi batch trong 1 transaction
+    if not entries:
+        return
+    rows = [(domain, u) + tuple(e.get(k) for k in URL_COLUMNS) for u, e in entries.items()]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO urls(domain, url, hash, hash_raw, len, etag, last_modified) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def migrate_legacy_urls(conn, state):
+    # state.json cũ lưu site_state["urls"] = {url: {...}} -> chuyển một lần sang state.db
+    migrated = False
+    for domain, site_state in state.get("sites", {}).items():
+        legacy = site_state.pop("urls", None)
+        if legacy:
+            save_url_entries(conn, domain, legacy)
+            migrated = True
+    return migrated
 
 def clamp_urls(urls, limits, remaining_total_budget):
     # cắt theo limit mỗi site và ngân sách tổng
@@ -285,9 +532,22 @@ def append_to_google_sheets(summary_rows):
 
 # --------------------------------------------------------------------------- #
 
-def main():
+async def main():
     sites_cfg, change_threshold, limits, options = load_config()
     state = load_state()
+    conn = open_url_store()
+    try:
+        if migrate_legacy_urls(conn, state):
+            # ghi ngay state.json đã bỏ "urls" để lần chạy sau không migrate đè lên dữ liệu mới
+            save_state(state)
+        async with make_client(limits) as client:
+            await run_sites(client, conn, sites_cfg, change_threshold, limits, options, state)
+    finally:
+        conn.close()
+
+async def run_sites(client, conn, sites_cfg, change_threshold, limits, options, state):
+    sem_by_host = defaultdict(lambda: asyncio.Semaphore(limits.per_host_concurrency))
+    limiter = HostLimiter(max(0.0, limits.polite_sleep_ms / 1000.0))
 
     # Phát hiện "cold start": chưa có state nào
     is_cold_start = (not os.path.exists(STATE_FILE)) or (not state.get("sites"))
@@ -301,12 +561,12 @@ def main():
 
     for site in sites_cfg:
         base = site["url"].rstrip("/")
-        include_paths = site.get("include_paths") or []
-        exclude_paths = site.get("exclude_paths") or []
+        include_paths = tuple(site.get("include_paths") or ())
+        exclude_paths = tuple(site.get("exclude_paths") or ())
         domain_key = urlparse(base).netloc
 
         print(f"==> Processing {base}")
-        site_state = state["sites"].get(domain_key, {"urls": {}, "last_run": 0})
+        site_state = state["sites"].get(domain_key, {"last_run": 0})
 
         # 1) Thu thập URL từ sitemap
         sitemap_url = discover_sitemaps(base, timeout=limits.request_timeout_sec, retries=limits.request_retries)
@@ -323,39 +583,57 @@ def main():
                 urls |= parse_rss_items(f, limits.request_timeout_sec, limits.request_retries, limits)
 
         # 3) Lọc include/exclude + limit ngân sách
-        urls = [u for u in urls if should_include(u, include_paths, exclude_paths)]
+        urls = [u for u in urls if should_include(url_parts(u)[1], include_paths, exclude_paths)]
         urls = clamp_urls(urls, limits, remaining_total)
         remaining_total -= len(urls)
         print(f"  Collected {len(urls)} URLs after filters/limits")
 
-        new_urls, changed_urls, gone_urls = [], [], []
-
-        # 4) So sánh fingerprint
-        for u in urls:
-            try:
-                h, L = content_fingerprint(u, limits.request_timeout_sec, limits.request_retries, limits.polite_sleep_ms)
-            except Exception as e:
-                print("  Fetch fail:", u, e)
+        new_urls, changed_urls = [], []
+
+        # 4) So sánh fingerprint (fetch song song, giới hạn theo host)
+        url_list = list(urls)
+        prev_by_url = {u: load_url_entry(conn, domain_key, u) for u in url_list}
+        hosts = [url_parts(u)[0] for u in url_list]
+        tasks = [
+            asyncio.create_task(bounded_fingerprint(sem_by_host[host], limiter, host, client, u, prev_by_url[u], limits))
+            for u, host in zip(url_list, hosts)
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        updates = {}
+        for u, res in zip(url_list, results):
+            if isinstance(res, Exception):
+                print("  Fetch fail:", u, res)
                 continue
+            h, L = res["hash"], res["len"]
 
-            prev = site_state["urls"].get(u)
+            prev = prev_by_url[u]
             if prev is None:
                 new_urls.append(u)
+            elif not prev["hash"].startswith(HASH_PREFIX):
+                # hash kiểu cũ (SHA-256): không so sánh được, chỉ ghi lại baseline mới
+                pass
             else:
                 if prev["hash"] != h:
                     prev_len = int(prev.get("len", 0))
                     if abs(L - prev_len) >= change_threshold:
                         changed_urls.append(u)
-            site_state["urls"][u] = {"hash": h, "len": L}
+            updates[u] = res
+        save_url_entries(conn, domain_key, updates)
 
         # 5) URL biến mất (trong state nhưng không còn ở sitemap/RSS)
         current_set = set(urls)
-        for u in list(site_state["urls"].keys()):
+        gone_candidates = set(load_site_urls(conn, domain_key)) - current_set
+        if include_paths:
             # nếu nay cấu hình đã siết include/exclude thì bỏ qua URL ngoài phạm vi
-            if include_paths and not should_include(u, include_paths, exclude_paths):
-                continue
-            if u not in current_set:
-                gone_urls.append(u)
+            inc_re = compile_prefix_re(include_paths)
+            exc_re = compile_prefix_re(exclude_paths)
+            kept = []
+            for u in gone_candidates:
+                path = url_parts(u)[1]
+                if inc_re.match(path) and not (exc_re and exc_re.match(path)):
+                    kept.append(u)
+            gone_candidates = kept
+        gone_urls = sorted(gone_candidates)
 
         # 6) Tạo thông điệp (chỉ gửi nếu không phải cold start)
         blocks = []
@@ -402,10 +680,11 @@ def main():
         return
 
     if all_reports:
-        for m in all_reports:
+        # gộp báo cáo các site vào ít request nhất có thể
+        for m in batch_reports(all_reports):
             post_to_slack(SLACK_WEBHOOK_URL, m)
     else:
         post_to_slack(SLACK_WEBHOOK_URL, "✅ Không có thay đổi đáng kể (> threshold) trong lần quét hôm nay.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())